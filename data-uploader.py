@@ -1,4 +1,7 @@
 import argparse
+import mmap
+import multiprocessing
+import os
 import time
 import sys
 import re
@@ -18,6 +21,16 @@ COMMENT_CHAR = '#'
 METADATA_CHAR = '!'
 BACKEND = "https://api.iobeam.com/v1/"
 
+# Maximum number of offending line numbers reported per error type and file
+VALIDATE_MAX_REPORTED_LINES = 20
+
+# Size in bytes of the file chunks validated in parallel
+VALIDATE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Per-column aggregations for downsampling, and those requiring numeric columns
+AGGREGATORS = ['min', 'max', 'mean', 'first', 'last']
+NUMERIC_AGGREGATORS = ['min', 'max', 'mean']
+
 ###############################################################
 
 _parser = argparse.ArgumentParser(version='0.2',
@@ -63,6 +76,24 @@ Device IDs must be specified in metadata headers if multiple input files
 are provided.  If a single input file is provided, device IDs can be
 specified either in metadata, from the command line, or the script
 will auto-assign.
+
+To check input files before uploading, use --validate-only. Files are
+split into chunks that are checked using all available CPUs for column
+counts, numeric and boolean types, null times, and decreasing times, and
+offending line numbers are reported per file. Nothing is sent to iobeam
+in this mode.
+
+Data can be reduced before sending by giving per-column options in
+parentheses after the column type, separated by ';':
+
+  ! columns: time[n], temperature[n](deadband=0.5;mean), status[s](deadband)
+
+A deadband omits a value that is within the given tolerance (default: 0,
+i.e., unchanged) of the last value sent for that column, and rows left
+without any values are dropped. With --downsample, rows are combined
+into time windows, with each column aggregated by min, max, mean
+(numeric columns only), first, or last (default). --dedupe drops rows
+identical to the previous row.
 ''')
 
 
@@ -96,6 +127,11 @@ class FileInfo:
         self.formatWithoutTimestamp = []
         self.formatTypesWithoutTimestamp = []
         self.timestampColumnIndex = -1
+        self.deadbands = []
+        self.aggregators = []
+
+        # Data reduction state, None if no reduction configured
+        self.reduction = None
 
         # iobeam objects
         self.iobeamClient = None
@@ -103,6 +139,19 @@ class FileInfo:
 
         # statistics
         self.sent = 0
+        self.reduced = 0
+        self.omitted = 0
+
+class ReductionState:
+    def __init__(self, columns):
+        # Last row read, for removing duplicates
+        self.lastRow = None
+        # Last value sent per column, for deadbands
+        self.lastSent = [None] * columns
+        # Aggregates of the current time window, for downsampling
+        self.bucketStart = None
+        self.bucketValues = [None] * columns
+        self.bucketCounts = [0] * columns
 
 
 def returnError(error):
@@ -203,6 +252,149 @@ def addData(progInfo, fileInfo, data, epochTs=0, cnt=0):
     return True
 
 
+def resetReduction(progInfo, fileInfo):
+    if progInfo.args.dedupe or progInfo.args.downsample > 0 \
+            or any([deadband != None for deadband in fileInfo.deadbands]):
+        fileInfo.reduction = ReductionState(len(fileInfo.format))
+
+
+def aggregateData(progInfo, fileInfo, data):
+    state = fileInfo.reduction
+
+    for i in range(0, len(data)):
+        value = data[i]
+        if value == None or i == fileInfo.timestampColumnIndex:
+            continue
+
+        aggregator = fileInfo.aggregators[i]
+        current = state.bucketValues[i]
+        if state.bucketCounts[i] == 0 or aggregator == None or aggregator == 'last':
+            current = value
+        elif aggregator == 'min':
+            current = min(current, value)
+        elif aggregator == 'max':
+            current = max(current, value)
+        elif aggregator == 'mean':
+            current += value
+
+        state.bucketValues[i] = current
+        state.bucketCounts[i] += 1
+
+
+# Returns the aggregated row of the current time window, if any, and starts a new one
+def flushBucket(progInfo, fileInfo):
+    state = fileInfo.reduction
+    if state.bucketStart == None:
+        return None
+
+    data = []
+    for i in range(0, len(fileInfo.format)):
+        if i == fileInfo.timestampColumnIndex:
+            data.append(state.bucketStart)
+        elif fileInfo.aggregators[i] == 'mean' and state.bucketCounts[i] > 0:
+            data.append(float(state.bucketValues[i]) / state.bucketCounts[i])
+        else:
+            data.append(state.bucketValues[i])
+
+    state.bucketStart = None
+    state.bucketValues = [None] * len(fileInfo.format)
+    state.bucketCounts = [0] * len(fileInfo.format)
+    return data
+
+
+# Returns the previous time window's row when this row starts a new window
+def downsampleData(progInfo, fileInfo, data):
+    state = fileInfo.reduction
+
+    thisTs = data[fileInfo.timestampColumnIndex]
+    bucketStart = thisTs - (thisTs % progInfo.args.downsample)
+
+    result = None
+    if state.bucketStart != None and state.bucketStart != bucketStart:
+        result = flushBucket(progInfo, fileInfo)
+
+    state.bucketStart = bucketStart
+    aggregateData(progInfo, fileInfo, data)
+    return result
+
+
+# Omits values within the deadband of the last value sent, dropping rows left empty
+def deadbandData(progInfo, fileInfo, data):
+    state = fileInfo.reduction
+
+    reducedData = list(data)
+    suppressed = 0
+    for i in range(0, len(data)):
+        deadband = fileInfo.deadbands[i]
+        value = data[i]
+        if deadband == None or value == None:
+            continue
+
+        last = state.lastSent[i]
+        if fileInfo.formatTypes[i] == ColTypes.number:
+            unchanged = last != None and abs(value - last) <= deadband
+        else:
+            unchanged = last == value
+
+        if unchanged:
+            reducedData[i] = None
+            suppressed += 1
+        else:
+            state.lastSent[i] = value
+
+    if suppressed:
+        values = [reducedData[i] for i in range(0, len(reducedData)) \
+                      if i != fileInfo.timestampColumnIndex]
+        if all([value == None for value in values]):
+            return None
+
+    # Values in dropped rows are already counted with the rows
+    fileInfo.omitted += suppressed
+    return reducedData
+
+
+# Returns the row to send, or None if it was dropped or held back for downsampling
+def reduceData(progInfo, fileInfo, data):
+    state = fileInfo.reduction
+
+    # Leave rows without a valid time for addData() to reject
+    if fileInfo.timestampColumnIndex >= 0 \
+            and type(data[fileInfo.timestampColumnIndex]) is not int:
+        return data
+
+    fileInfo.reduced += 1
+
+    if progInfo.args.dedupe:
+        if data == state.lastRow:
+            return None
+        state.lastRow = list(data)
+
+    if progInfo.args.downsample > 0:
+        data = downsampleData(progInfo, fileInfo, data)
+        if data == None:
+            return None
+
+    data = deadbandData(progInfo, fileInfo, data)
+    if data:
+        fileInfo.reduced -= 1
+    return data
+
+
+# Returns any row held back for downsampling at the end of the file
+def flushReducedData(progInfo, fileInfo):
+    if progInfo.args.downsample <= 0:
+        return None
+
+    data = flushBucket(progInfo, fileInfo)
+    if data == None:
+        return None
+
+    data = deadbandData(progInfo, fileInfo, data)
+    if data:
+        fileInfo.reduced -= 1
+    return data
+
+
 # Upload delay between data batches accorded to cmd line option
 def analyzeFiles(progInfo):
     assert(not progInfo.args.xmit_by_column_time)
@@ -215,11 +407,14 @@ def analyzeFiles(progInfo):
     except (OSError, IOError) as e:
         returnError("Problem opening file")
 
+    for fileInfo, file in inputFiles:
+        resetReduction(progInfo, fileInfo)
+
     try:
-        addedAny = True
-        while addedAny:
+        readAny = True
+        while readAny:
 
-            addedAny = False
+            readAny = False
             epochTs = int(time.time() * progInfo.timeMultiplier)
 
             for fileInfo, file in inputFiles:
@@ -230,9 +425,14 @@ def analyzeFiles(progInfo):
                     if len(line) == 0 or line[0] == COMMENT_CHAR or line[0] == METADATA_CHAR:
                         continue
 
+                    readAny = True
+
                     # Split CSV line into individual values
                     cleanedData = cleanData(progInfo, fileInfo, splitData(line))
 
+                    if cleanedData and fileInfo.reduction:
+                        cleanedData = reduceData(progInfo, fileInfo, cleanedData)
+
                     if cleanedData:
                         result = addData(progInfo, fileInfo, cleanedData, epochTs, cnt)
                         if result:
@@ -243,11 +443,17 @@ def analyzeFiles(progInfo):
                         break
                     else:
                         cnt += 1
+                else:
+                    # End of file, add any data held back by reduction
+                    if fileInfo.reduction:
+                        cleanedData = flushReducedData(progInfo, fileInfo)
+                        if cleanedData and addData(progInfo, fileInfo, cleanedData, epochTs, cnt):
+                            addedThis = True
+                            fileInfo.sent += 1
 
                 if addedThis:
                     print "Sending data batch to iobeam for file %s" % fileInfo.filename
                     fileInfo.iobeamClient.send()
-                    addedAny = True
 
 
             time.sleep((progInfo.args.delay_bw / 1000.0))
@@ -270,6 +476,8 @@ def analyzeFileWithIncludedDelay(progInfo):
     except (OSError, IOError) as e:
         returnError("Problem opening file")
 
+    resetReduction(progInfo, fileInfo)
+
     try:
         line = file.readline()
         nextCleanedData = None
@@ -291,8 +499,10 @@ def analyzeFileWithIncludedDelay(progInfo):
                 continue
 
             thisTime = cleanedData[fileInfo.timestampColumnIndex]
-            result = addData(progInfo, fileInfo, cleanedData)
-            if result:
+            if fileInfo.reduction:
+                cleanedData = reduceData(progInfo, fileInfo, cleanedData)
+
+            if cleanedData and addData(progInfo, fileInfo, cleanedData):
                 fileInfo.sent += 1
                 fileInfo.iobeamClient.send()
 
@@ -309,6 +519,13 @@ def analyzeFileWithIncludedDelay(progInfo):
 
             line = nextLine
 
+        # End of file, send any data held back by reduction
+        if fileInfo.reduction:
+            cleanedData = flushReducedData(progInfo, fileInfo)
+            if cleanedData and addData(progInfo, fileInfo, cleanedData):
+                fileInfo.sent += 1
+                fileInfo.iobeamClient.send()
+
     except (OSError) as e:
         print e
         returnError("Problem reading file")
@@ -318,6 +535,213 @@ def analyzeFileWithIncludedDelay(progInfo):
 ###############################################################
 
 
+def recordInvalidLine(errors, errorType, lineNo):
+    if errorType not in errors:
+        errors[errorType] = [0, []]
+    errors[errorType][0] += 1
+    if len(errors[errorType][1]) < VALIDATE_MAX_REPORTED_LINES:
+        errors[errorType][1].append(lineNo)
+
+
+# Split a file into newline-aligned (start, end) byte ranges of about VALIDATE_CHUNK_SIZE
+def chunkFile(filename):
+    with open(filename, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            # Empty files cannot be memory-mapped
+            return []
+
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunks = []
+            start = 0
+            while start < size:
+                end = data.find('\n', min(start + VALIDATE_CHUNK_SIZE, size) - 1)
+                end = size if end < 0 else end + 1
+                chunks.append((start, end))
+                start = end
+            return chunks
+        finally:
+            data.close()
+
+
+# Runs in a worker process, so takes plain values rather than FileInfo.
+# Line numbers are relative to the start of the chunk.
+def validateChunk(task):
+    filename, start, end, format, formatTypes, timestampColumnIndex, null_string = task
+
+    lineNo = 0
+    rows = 0
+    invalidRows = 0
+    errors = {}
+    firstTime = None
+    firstTimeLine = None
+    firstTimeRowInvalid = False
+    lastTime = None
+
+    # Only typed columns need checking, so avoid looking at string columns per row
+    checkedColumns = [(i, formatTypes[i]) for i in range(0, len(format)) \
+                          if formatTypes[i] != ColTypes.string]
+
+    try:
+        with open(filename, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                lines = data[start:end].split('\n')
+            finally:
+                data.close()
+
+        # Chunks end on a newline, which leaves an empty string after the last line
+        if len(lines) > 0 and len(lines[-1]) == 0:
+            lines.pop()
+
+        for line in lines:
+            lineNo += 1
+            line = line.strip()
+            if len(line) == 0 or line[0] == COMMENT_CHAR or line[0] == METADATA_CHAR:
+                continue
+
+            rows += 1
+            rowErrors = []
+            rawData = line.split(',')
+            if len(format) != len(rawData):
+                recordInvalidLine(errors, "Number of columns mismatch", lineNo)
+                invalidRows += 1
+                continue
+
+            for i, colType in checkedColumns:
+                item = rawData[i].strip()
+                if len(item) == 0 or item.lower() == null_string:
+                    if i == timestampColumnIndex:
+                        rowErrors.append("Null time")
+                elif i == timestampColumnIndex:
+                    try:
+                        number = int(item)
+                    except ValueError:
+                        if toNumber(item) == None:
+                            rowErrors.append("Column %s not numeric" % format[i])
+                        else:
+                            rowErrors.append("Time not an integer")
+                        continue
+
+                    if type(number) is not int:
+                        rowErrors.append("Time not an integer")
+                        continue
+
+                    if lastTime != None and number < lastTime:
+                        rowErrors.append("Time decreasing")
+                    if firstTime == None:
+                        firstTime = number
+                        firstTimeLine = lineNo
+                    lastTime = number
+                elif colType == ColTypes.number:
+                    # float() accepts everything toNumber() does
+                    try:
+                        float(item)
+                    except ValueError:
+                        rowErrors.append("Column %s not numeric" % format[i])
+                elif colType == ColTypes.bool:
+                    if toBool(item) == None:
+                        rowErrors.append("Column %s not boolean" % format[i])
+
+            if rowErrors:
+                invalidRows += 1
+                if firstTimeLine == lineNo:
+                    firstTimeRowInvalid = True
+                for errorType in rowErrors:
+                    recordInvalidLine(errors, errorType, lineNo)
+
+    except (OSError, IOError) as e:
+        return (lineNo, rows, invalidRows, errors, firstTime, firstTimeLine,
+                firstTimeRowInvalid, lastTime, "Problem reading file: %s" % e)
+
+    return (lineNo, rows, invalidRows, errors, firstTime, firstTimeLine,
+            firstTimeRowInvalid, lastTime, None)
+
+
+# Check all input files in parallel without sending data, returns whether all are valid
+def validateFiles(progInfo):
+
+    tasks = []
+    fileTasks = []
+    readErrors = {}
+    for filename in progInfo.args.input_file:
+        fileInfo = progInfo.files[filename]
+        try:
+            chunks = chunkFile(fileInfo.filename)
+        except (OSError, IOError) as e:
+            readErrors[filename] = "Problem reading file: %s" % e
+            chunks = []
+
+        fileTasks.append((filename, len(tasks), len(chunks)))
+        for start, end in chunks:
+            tasks.append((fileInfo.filename, start, end, fileInfo.format, fileInfo.formatTypes,
+                          fileInfo.timestampColumnIndex, progInfo.args.null_string))
+
+    processes = min(len(tasks), multiprocessing.cpu_count())
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(validateChunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(validateChunk, tasks)
+
+    allValid = True
+    print "\nValidation results:"
+    for filename, firstTask, taskCount in fileTasks:
+        lineOffset = 0
+        rows = 0
+        invalidRows = 0
+        errors = {}
+        lastTime = None
+        readError = readErrors.get(filename)
+
+        # Merge chunk results in file order, checking times across chunk boundaries
+        for chunkLines, chunkRows, chunkInvalidRows, chunkErrors, firstTime, firstTimeLine, \
+                firstTimeRowInvalid, chunkLastTime, chunkReadError in results[firstTask:firstTask + taskCount]:
+            readError = readError or chunkReadError
+
+            if lastTime != None and firstTime != None and firstTime < lastTime:
+                if not firstTimeRowInvalid:
+                    invalidRows += 1
+                recordInvalidLine(errors, "Time decreasing", lineOffset + firstTimeLine)
+
+            for errorType, (count, lines) in chunkErrors.items():
+                if errorType not in errors:
+                    errors[errorType] = [0, []]
+                errors[errorType][0] += count
+                errors[errorType][1] = sorted(errors[errorType][1] + \
+                    [lineOffset + line for line in lines])[:VALIDATE_MAX_REPORTED_LINES]
+
+            lineOffset += chunkLines
+            rows += chunkRows
+            invalidRows += chunkInvalidRows
+            if chunkLastTime != None:
+                lastTime = chunkLastTime
+
+        if readError:
+            allValid = False
+            print "\t%s: %s" % (filename, readError)
+            continue
+
+        print "\t%s: %d rows checked, %d invalid" % (filename, rows, invalidRows)
+        for errorType in sorted(errors.keys()):
+            count, lines = errors[errorType]
+            more = ", ..." if count > len(lines) else ""
+            print "\t\t%s: %d (lines %s%s)" \
+                % (errorType, count, ", ".join(map(str, lines)), more)
+        if invalidRows > 0:
+            allValid = False
+
+    return allValid
+
+
+###############################################################
+
+
 def getMetaData(line):
     assert(len(line) > 0 and line[0] == METADATA_CHAR);
     try:
@@ -331,10 +755,40 @@ def getMetaData(line):
         return None
 
 
+def extractReduction(fileInfo, col, colType, spec):
+    deadband = None
+    aggregator = None
+    if not spec:
+        return (deadband, aggregator)
+
+    for option in spec.split(';'):
+        option = option.strip().lower()
+        if option == 'deadband':
+            deadband = 0
+        elif option.startswith('deadband='):
+            deadband = toNumber(option[len('deadband='):])
+            if deadband == None or deadband < 0:
+                returnError("Invalid deadband in file %s: %s " % (fileInfo.filename, col))
+            if deadband > 0 and colType != ColTypes.number:
+                returnError("Deadband tolerance requires numeric column in file %s: %s " \
+                                % (fileInfo.filename, col))
+        elif option in AGGREGATORS:
+            if aggregator != None:
+                returnError("Multiple aggregations for column in file %s: %s " % (fileInfo.filename, col))
+            if option in NUMERIC_AGGREGATORS and colType != ColTypes.number:
+                returnError("Aggregation %s requires numeric column in file %s: %s " \
+                                % (option, fileInfo.filename, col))
+            aggregator = option
+        else:
+            returnError("Invalid data reduction in file %s: %s " % (fileInfo.filename, col))
+
+    return (deadband, aggregator)
+
+
 def extractFormatAndTypes(fileInfo, metadata):
 
     for col in metadata:
-        m = re.search('^([A-Za-z0-9_\-]+)(\[([A-Za-z]+)\])?', col)
+        m = re.search('^([A-Za-z0-9_\-]+)\s*(\[([A-Za-z]+)\])?\s*(\(([^)]*)\))?\s*$', col)
         if not m:
             returnError("Invalid column specification in file %s: %s " % (fileInfo.filename, col))
 
@@ -358,6 +812,10 @@ def extractFormatAndTypes(fileInfo, metadata):
             else:
                 returnError("Invalid column type in file %s: %s " % (fileInfo.filename, col))
 
+        deadband, aggregator = extractReduction(fileInfo, col, fileInfo.formatTypes[-1], m.group(5))
+        fileInfo.deadbands.append(deadband)
+        fileInfo.aggregators.append(aggregator)
+
     fileInfo.formatWithoutTimestamp = list(fileInfo.format)
     fileInfo.formatTypesWithoutTimestamp = list(fileInfo.formatTypes)
 
@@ -367,6 +825,8 @@ def extractFormatAndTypes(fileInfo, metadata):
 
         if fileInfo.formatTypes[timestampIndex] != ColTypes.number:
             returnError("Timestamp column not numeric type in file %s" % fileInfo.filename)
+        if fileInfo.deadbands[timestampIndex] != None or fileInfo.aggregators[timestampIndex] != None:
+            returnError("Data reduction not supported on timestamp column in file %s" % fileInfo.filename)
 
         del fileInfo.formatWithoutTimestamp[timestampIndex]
         del fileInfo.formatTypesWithoutTimestamp[timestampIndex]
@@ -451,6 +911,18 @@ def extractAllMetaData(progInfo):
     if progInfo.args.xmit_by_column_time and not progInfo.timeFromColumns:
         returnError("Transmission by included time requested, but no timestamps present in input file(s)")
 
+    # Data reduction only applies to uploads, so validation doesn't need matching flags
+    if progInfo.args.validate_only:
+        return
+
+    if progInfo.args.downsample > 0 and not progInfo.timeFromColumns:
+        returnError("Downsampling requested, but no timestamps present in input file(s)")
+
+    if progInfo.args.downsample == 0:
+        for fileInfo in progInfo.files.values():
+            if any([aggregator != None for aggregator in fileInfo.aggregators]):
+                returnError("Aggregation in file %s requires --downsample" % fileInfo.filename)
+
 
 
 def configureMetaData(progInfo):
@@ -487,9 +959,9 @@ def checkArgs(args):
         returnError("No input files provided")
     if args.device_id != None and len(args.input_file) > 1:
         returnError("If supplying > 1 input file, device info cannot be provided from command-line")
-    if args.project_id == None:
+    if args.project_id == None and not args.validate_only:
         returnError("Unknown project ID")
-    if args.token == None:
+    if args.token == None and not args.validate_only:
         returnError("Unknown project token")
     if args.rows_per <= 0:
         returnError("Number of rows must be > 0")
@@ -497,6 +969,8 @@ def checkArgs(args):
         returnError("Delay must be >= 0 milliseconds")
     if args.xmit_count < 0:
         returnError("xmit_count must be >= 0")
+    if args.downsample < 0:
+        returnError("Downsample window must be >= 0")
 
     args.time_fidelity = args.time_fidelity.lower()
     if not args.time_fidelity in ['sec', 'msec', 'usec']:
@@ -544,15 +1018,28 @@ if __name__ == "__main__":
                          help='case-insensitive string to represent null element (default: null)', default='null')
     _parser.add_argument('--skip-invalid', action='store_true', dest='skip_invalid',
                          help='skip invalid rows from input (otherwise exits with error)')
+    _parser.add_argument('--validate-only', action='store_true', dest='validate_only',
+                         help='check input file(s) for invalid rows and exit without sending data')
+
+    _parser.add_argument('--dedupe', action='store_true', dest='dedupe',
+                         help='drop rows identical to the previous row')
+    _parser.add_argument('--downsample', action='store', dest='downsample', type=int,
+                         help='window for downsampling rows by included time, in time fidelity units\n'
+                              '(disabled: 0, default: 0)', default=0)
 
     _parser.set_defaults(skip_invalid=False)
     _parser.set_defaults(xmit_by_column_time=False)
+    _parser.set_defaults(validate_only=False)
+    _parser.set_defaults(dedupe=False)
 
     args = _parser.parse_args()
     checkArgs(args)
 
     progInfo = ProgramInfo(args)
     extractAllMetaData(progInfo)
+
+    if args.validate_only:
+        sys.exit(0 if validateFiles(progInfo) else 1)
     configureMetaData(progInfo)
 
     builder = iobeam.ClientBuilder(args.project_id, args.token).setBackend(BACKEND)
@@ -580,4 +1067,8 @@ if __name__ == "__main__":
 
     print "\nResults:"
     for fileInfo in progInfo.files.values():
-        print "\t%s: %d rows sent" % (fileInfo.filename, fileInfo.sent)
+        if fileInfo.reduction:
+            print "\t%s: %d rows sent, %d rows removed and %d values omitted by data reduction" \
+                  % (fileInfo.filename, fileInfo.sent, fileInfo.reduced, fileInfo.omitted)
+        else:
+            print "\t%s: %d rows sent" % (fileInfo.filename, fileInfo.sent)